@@ -1,11 +1,16 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import openai
 import os
 import json
-from typing import List, Dict, Any
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -22,6 +27,12 @@ CORS(app)
 # OpenAI configuration
 openai.api_key = os.getenv('OPENAI_API_KEY', 'your-openai-api-key')
 
+# Meal plan batching
+MEAL_PLAN_MAX_WORKERS = int(os.getenv('MEAL_PLAN_MAX_WORKERS', '4'))
+MEAL_PLAN_MAX_HOUSEHOLDS = 50
+RECIPE_CACHE_SIZE = 1000
+RECIPES_PER_PLAN = 3
+
 # Database Models
 class User(db.Model):
     __tablename__ = 'users'
@@ -50,6 +61,7 @@ class Recipe(db.Model):
     dietary_tags = db.Column(db.Text)  # JSON string of dietary tags
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     popularity_score = db.Column(db.Float, default=0.0)
+    request_key = db.Column(db.String(64), index=True)  # Hash of normalized ingredients + dietary needs
 
 class SavedRecipe(db.Model):
     __tablename__ = 'saved_recipes'
@@ -68,13 +80,41 @@ class UserAnalytics(db.Model):
     user_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=False)
     action = db.Column(db.String(100), nullable=False)
     data = db.Column(db.Text)  # JSON string of additional data
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    # Frequently queried fields extracted from data at write time
+    dietary_needs = db.Column(db.String(100))
+    ingredients_count = db.Column(db.Integer)
+    recipes_count = db.Column(db.Integer)
+    recipe_id = db.Column(db.String(50))
+    
+    __table_args__ = (
+        db.Index('ix_user_analytics_action_timestamp', 'action', 'timestamp'),
+    )
+
+class AnalyticsBucket(db.Model):
+    __tablename__ = 'analytics_buckets'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    granularity = db.Column(db.String(10), nullable=False)  # 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    action = db.Column(db.String(100), nullable=False)
+    dietary_needs = db.Column(db.String(100), nullable=False, default='')
+    event_count = db.Column(db.Integer, nullable=False, default=0)
+    ingredients_total = db.Column(db.BigInteger, nullable=False, default=0)
+    recipes_total = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'action', 'bucket_start', 'dietary_needs',
+                            name='uq_analytics_bucket'),
+    )
 
 # Helper Functions
 def generate_recipe_id():
     import time
-    import random
-    return f"recipe_{int(time.time())}_{random.randint(1000, 9999)}"
+    import uuid
+    # Random suffix must stay unique across concurrent meal plan calls
+    return f"recipe_{int(time.time())}_{uuid.uuid4().hex[:8]}"
 
 def get_or_create_user(user_id: str) -> User:
     user = User.query.get(user_id)
@@ -87,9 +127,11 @@ def get_or_create_user(user_id: str) -> User:
         db.session.commit()
     return user
 
-def call_openai_api(ingredients: List[str], dietary_needs: str = None) -> List[Dict]:
+def call_openai_api(ingredients: List[str], dietary_needs: str = None, fallback: bool = True) -> List[Dict]:
     """
-    Call OpenAI API to generate recipe recommendations
+    Call OpenAI API to generate recipe recommendations.
+    With fallback=False, API and parse errors are raised instead of
+    returning the local template recipes.
     """
     try:
         # Construct prompt for OpenAI
@@ -138,6 +180,8 @@ def call_openai_api(ingredients: List[str], dietary_needs: str = None) -> List[D
         
     except Exception as e:
         print(f"OpenAI API Error: {e}")
+        if not fallback:
+            raise
         # Fallback to local generation
         return generate_fallback_recipes(ingredients, dietary_needs)
 
@@ -187,6 +231,113 @@ def generate_fallback_recipes(ingredients: List[str], dietary_needs: str = None)
     
     return recipes
 
+# Front cache of recipe ids per request key, shared by request threads
+recipe_cache: "OrderedDict[str, List[str]]" = OrderedDict()
+recipe_cache_lock = threading.Lock()
+
+def recipe_request_key(ingredients: List[str], dietary_needs: str = None) -> str:
+    """Hash the normalized ingredients and dietary needs of a generation request"""
+    normalized = sorted({str(i).strip().lower() for i in ingredients if str(i).strip()})
+    payload = json.dumps([normalized, (dietary_needs or '').strip().lower()])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def cache_recipe_ids(key: str, recipe_ids: List[str]):
+    with recipe_cache_lock:
+        recipe_cache[key] = recipe_ids
+        recipe_cache.move_to_end(key)
+        if len(recipe_cache) > RECIPE_CACHE_SIZE:
+            # Evict the least recently used entry
+            recipe_cache.popitem(last=False)
+
+def recipe_to_dict(recipe: Recipe) -> Dict:
+    ingredients = json.loads(recipe.ingredients) if recipe.ingredients else []
+    return {
+        'id': recipe.id,
+        'name': recipe.name,
+        'description': recipe.description,
+        'ingredients': ingredients,
+        'usedIngredients': ingredients,
+        'instructions': recipe.instructions,
+        'nutrition_benefits': recipe.nutrition_benefits,
+        'servings': recipe.servings,
+        'prep_time': recipe.prep_time
+    }
+
+def build_recipe(recipe_data: Dict, ingredients: List[str], dietary_needs: str = None,
+                 request_key: str = None) -> Recipe:
+    return Recipe(
+        id=recipe_data['id'],
+        name=recipe_data['name'],
+        description=recipe_data['description'],
+        ingredients=json.dumps(recipe_data.get('usedIngredients', ingredients)),
+        instructions=recipe_data['instructions'],
+        nutrition_benefits=recipe_data['nutrition_benefits'],
+        servings=recipe_data.get('servings', 4),
+        prep_time=recipe_data.get('prep_time', '30 minutes'),
+        dietary_tags=json.dumps([dietary_needs] if dietary_needs else []),
+        request_key=request_key
+    )
+
+def build_plan_recipes(recipes: List[Dict], ingredients: List[str], dietary_needs: str = None,
+                       request_key: str = None) -> List[Recipe]:
+    """Validate generated recipes for one household, raising ValueError if any is unusable"""
+    if not isinstance(recipes, list) or not recipes:
+        raise ValueError('No recipes generated')
+    try:
+        return [build_recipe(recipe_data, ingredients, dietary_needs, request_key) for recipe_data in recipes]
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f'Malformed recipe: {e}')
+
+def resolve_cached_recipes(keys: List[str]) -> Dict[str, List[Dict]]:
+    """Load previously generated recipes for the given request keys in one query"""
+    keys = set(keys)
+    with recipe_cache_lock:
+        cached_ids = {key: recipe_cache[key] for key in keys if key in recipe_cache}
+        for key in cached_ids:
+            recipe_cache.move_to_end(key)
+    all_ids = {recipe_id for ids in cached_ids.values() for recipe_id in ids}
+    uncached = keys - set(cached_ids)
+    
+    conditions = []
+    if all_ids:
+        conditions.append(Recipe.id.in_(all_ids))
+    if uncached:
+        # Only the newest RECIPES_PER_PLAN recipes per key, ties broken by id
+        ranked = db.session.query(
+            Recipe.id.label('id'),
+            db.func.row_number().over(
+                partition_by=Recipe.request_key,
+                order_by=(Recipe.created_at.desc(), Recipe.id.desc())
+            ).label('position')
+        ).filter(Recipe.request_key.in_(uncached)).subquery()
+        conditions.append(Recipe.id.in_(
+            db.select(ranked.c.id).where(ranked.c.position <= RECIPES_PER_PLAN)
+        ))
+    if not conditions:
+        return {}
+    
+    stored = Recipe.query.filter(db.or_(*conditions)).order_by(
+        Recipe.created_at.desc(), Recipe.id.desc()
+    ).all()
+    by_id = {r.id: r for r in stored}
+    resolved = {}
+    for key, ids in cached_ids.items():
+        # Only reuse an entry if every recipe is still stored
+        if all(recipe_id in by_id for recipe_id in ids):
+            resolved[key] = [recipe_to_dict(by_id[recipe_id]) for recipe_id in ids]
+        else:
+            with recipe_cache_lock:
+                recipe_cache.pop(key, None)
+    
+    by_key = {}
+    for recipe in stored:
+        if recipe.request_key in uncached:
+            by_key.setdefault(recipe.request_key, []).append(recipe)
+    for key, recipes in by_key.items():
+        resolved[key] = [recipe_to_dict(r) for r in recipes]
+        cache_recipe_ids(key, [r.id for r in recipes])
+    return resolved
+
 # API Routes
 @app.route('/')
 def index():
@@ -207,21 +358,17 @@ def generate_recipes():
         user = get_or_create_user(user_id)
         
         # Generate recipes using OpenAI or fallback
-        recipes = call_openai_api(ingredients, dietary_needs)
+        try:
+            recipes = call_openai_api(ingredients, dietary_needs, fallback=False)
+            request_key = recipe_request_key(ingredients, dietary_needs)
+        except Exception:
+            # Template recipes are never reused for later requests
+            recipes = generate_fallback_recipes(ingredients, dietary_needs)
+            request_key = None
         
         # Save recipes to database
         for recipe_data in recipes:
-            recipe = Recipe(
-                id=recipe_data['id'],
-                name=recipe_data['name'],
-                description=recipe_data['description'],
-                ingredients=json.dumps(recipe_data.get('usedIngredients', ingredients)),
-                instructions=recipe_data['instructions'],
-                nutrition_benefits=recipe_data['nutrition_benefits'],
-                servings=recipe_data.get('servings', 4),
-                prep_time=recipe_data.get('prep_time', '30 minutes'),
-                dietary_tags=json.dumps([dietary_needs] if dietary_needs else [])
-            )
+            recipe = build_recipe(recipe_data, ingredients, dietary_needs, request_key)
             
             # Check if recipe already exists
             existing = Recipe.query.get(recipe.id)
@@ -247,6 +394,168 @@ def generate_recipes():
         print(f"Error generating recipes: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/mealplans/generate', methods=['POST'])
+def generate_meal_plans():
+    """Generate meal plans for several households, streamed as NDJSON"""
+    try:
+        data = request.get_json() or {}
+        households = data.get('households', [])
+        user_id = data.get('user_id')
+        
+        if not households or not isinstance(households, list):
+            return jsonify({'success': False, 'error': 'No households provided'}), 400
+        if len(households) > MEAL_PLAN_MAX_HOUSEHOLDS:
+            return jsonify({
+                'success': False,
+                'error': f'At most {MEAL_PLAN_MAX_HOUSEHOLDS} households per request'
+            }), 400
+        for index, household in enumerate(households):
+            if not isinstance(household, dict):
+                return jsonify({'success': False, 'error': f'Household {index} must be an object'}), 400
+            ingredients = household.get('ingredients')
+            if not isinstance(ingredients, list) or not ingredients or \
+                    not all(isinstance(i, str) and i.strip() for i in ingredients):
+                return jsonify({
+                    'success': False,
+                    'error': f'Ingredients for household {index} must be a non-empty list of strings'
+                }), 400
+            if not isinstance(household.get('dietary_needs') or '', str):
+                return jsonify({
+                    'success': False,
+                    'error': f'Dietary needs for household {index} must be a string'
+                }), 400
+        
+        if user_id:
+            get_or_create_user(user_id)
+        
+    except Exception as e:
+        print(f"Error generating meal plans: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    def generate():
+        summary = {
+            'type': 'summary',
+            'success': True,
+            'households_count': len(households),
+            'llm_calls': 0,
+            'failed_households': 0,
+            'recipes_saved': 0
+        }
+        new_recipes = {}
+        generated = {}
+        pending = {}
+        executor = ThreadPoolExecutor(max_workers=MEAL_PLAN_MAX_WORKERS)
+        
+        try:
+            keys = [recipe_request_key(h['ingredients'], h.get('dietary_needs') or '') for h in households]
+            resolved = resolve_cached_recipes(keys)
+            
+            # Households with identical requests share a single LLM call
+            for index, key in enumerate(keys):
+                if key not in resolved:
+                    pending.setdefault(key, []).append(index)
+            
+            # Start the fan-out before writing anything to the client
+            futures = {}
+            for key, indexes in pending.items():
+                household = households[indexes[0]]
+                future = executor.submit(
+                    call_openai_api, household['ingredients'], household.get('dietary_needs') or '',
+                    fallback=False
+                )
+                futures[future] = key
+            summary['llm_calls'] = len(futures)
+            
+            for index, key in enumerate(keys):
+                if key in resolved:
+                    yield plan_line(index, households[index], resolved[key], 'cache')
+            
+            for future in as_completed(futures):
+                key = futures[future]
+                household = households[pending[key][0]]
+                ingredients = household['ingredients']
+                dietary_needs = household.get('dietary_needs') or ''
+                
+                # Validate each household on its own so one bad response can't sink the batch
+                try:
+                    recipes = future.result()
+                    rows = build_plan_recipes(recipes, ingredients, dietary_needs, key)
+                    source = 'generated'
+                except Exception as e:
+                    print(f"Meal plan generation error, using fallback: {e}")
+                    try:
+                        recipes = generate_fallback_recipes(ingredients, dietary_needs)
+                        rows = build_plan_recipes(recipes, ingredients, dietary_needs)
+                        source = 'fallback'
+                    except Exception as e:
+                        summary['failed_households'] += len(pending[key])
+                        for index in pending[key]:
+                            yield plan_error_line(index, households[index], str(e))
+                        continue
+                
+                # Fallback templates carry no request key, so they're never reused
+                if source == 'generated':
+                    generated[key] = [r.id for r in rows]
+                new_recipes.update({r.id: r for r in rows})
+                for index in pending[key]:
+                    yield plan_line(index, households[index], recipes, source)
+        
+        except Exception as e:
+            print(f"Error generating meal plans: {e}")
+            summary.update({'success': False, 'error': str(e)})
+        
+        finally:
+            # Don't wait on outstanding LLM calls if the client went away
+            executor.shutdown(wait=False, cancel_futures=True)
+            save_meal_plans(new_recipes, generated, summary)
+            
+            if user_id:
+                track_user_action(user_id, 'meal_plans_generated', {
+                    'households_count': len(households),
+                    'cached_count': len(households) - sum(len(i) for i in pending.values()),
+                    'recipes_count': summary['recipes_saved']
+                })
+        
+        yield json.dumps(summary) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def save_meal_plans(new_recipes: Dict[str, Recipe], generated: Dict[str, List[str]], summary: Dict):
+    """Persist every new meal plan recipe in one bulk write"""
+    if not new_recipes:
+        return
+    try:
+        existing = {r.id for r in Recipe.query.filter(Recipe.id.in_(new_recipes)).all()}
+        db.session.add_all([r for rid, r in new_recipes.items() if rid not in existing])
+        db.session.commit()
+        summary['recipes_saved'] = len(new_recipes) - len(existing)
+        for key, recipe_ids in generated.items():
+            cache_recipe_ids(key, recipe_ids)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error saving meal plans: {e}")
+        summary.update({'success': False, 'error': str(e), 'recipes_saved': 0})
+
+def plan_line(index: int, household: Dict, recipes: List[Dict], source: str) -> str:
+    return json.dumps({
+        'type': 'plan',
+        'index': index,
+        'household_id': household.get('household_id'),
+        'dietary_needs': household.get('dietary_needs', ''),
+        'source': source,
+        'recipes': recipes
+    }) + '\n'
+
+def plan_error_line(index: int, household: Dict, error: str) -> str:
+    return json.dumps({
+        'type': 'plan',
+        'index': index,
+        'household_id': household.get('household_id'),
+        'dietary_needs': household.get('dietary_needs', ''),
+        'success': False,
+        'error': error
+    }) + '\n'
+
 @app.route('/api/recipes/save', methods=['POST'])
 def save_user_recipe():
     try:
@@ -331,6 +640,97 @@ def track_analytics():
         print(f"Error tracking analytics: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def parse_timestamp(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp into naive UTC to match the stored columns"""
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def parse_analytics_window(granularity: str):
+    """Read start/end query parameters, defaulting to the last 24 hours or 7 days"""
+    end = request.args.get('end')
+    end = parse_timestamp(end) if end else datetime.utcnow()
+    start = request.args.get('start')
+    if start:
+        start = parse_timestamp(start)
+    else:
+        start = end - (timedelta(days=7) if granularity == 'day' else timedelta(hours=24))
+    return start, end
+
+@app.route('/api/analytics/query', methods=['GET'])
+def query_analytics():
+    """Aggregate tracked events per hour/day bucket over a bucket-aligned time range"""
+    try:
+        granularity = request.args.get('granularity', 'day')
+        action = request.args.get('action')
+        group_by = [g for g in request.args.get('group_by', '').split(',') if g]
+        
+        if granularity not in ANALYTICS_GRANULARITIES:
+            return jsonify({'success': False, 'error': f'Invalid granularity: {granularity}'}), 400
+        unknown = [g for g in group_by if g not in ANALYTICS_GROUP_BY]
+        if unknown:
+            return jsonify({'success': False, 'error': f'Invalid group_by: {", ".join(unknown)}'}), 400
+        
+        try:
+            start, end = parse_analytics_window(granularity)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'start and end must be ISO 8601 timestamps'}), 400
+        if start > end:
+            return jsonify({'success': False, 'error': 'start must not be after end'}), 400
+        
+        # Windows are widened to whole buckets on both edges
+        start = floor_to_bucket(start, granularity)
+        bucket_end = floor_to_bucket(end, granularity)
+        end = bucket_end if bucket_end == end else bucket_end + ANALYTICS_GRANULARITIES[granularity]
+        
+        group_columns = [ANALYTICS_GROUP_BY[g] for g in group_by]
+        query = db.session.query(
+            AnalyticsBucket.bucket_start,
+            *group_columns,
+            db.func.sum(AnalyticsBucket.event_count),
+            db.func.sum(AnalyticsBucket.ingredients_total),
+            db.func.sum(AnalyticsBucket.recipes_total)
+        ).filter(
+            AnalyticsBucket.granularity == granularity,
+            AnalyticsBucket.bucket_start >= start,
+            AnalyticsBucket.bucket_start < end
+        )
+        if action:
+            query = query.filter(AnalyticsBucket.action == action)
+        
+        rows = query.group_by(
+            AnalyticsBucket.bucket_start, *group_columns
+        ).order_by(AnalyticsBucket.bucket_start).all()
+        
+        buckets = []
+        for row in rows:
+            bucket = {'bucket_start': row[0].isoformat()}
+            for i, name in enumerate(group_by):
+                bucket[name] = row[1 + i]
+            event_count, ingredients_total, recipes_total = row[1 + len(group_by):]
+            bucket.update({
+                'event_count': int(event_count or 0),
+                'ingredients_total': int(ingredients_total or 0),
+                'recipes_total': int(recipes_total or 0)
+            })
+            buckets.append(bucket)
+        
+        return jsonify({
+            'success': True,
+            'granularity': granularity,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'group_by': group_by,
+            'buckets': buckets
+        })
+        
+    except Exception as e:
+        print(f"Error querying analytics: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/health/tips', methods=['GET'])
 def get_health_tips():
     try:
@@ -433,17 +833,105 @@ def analyze_nutrition():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 # Utility Functions
+ANALYTICS_GRANULARITIES = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1)
+}
+ANALYTICS_GROUP_BY = {
+    'action': AnalyticsBucket.action,
+    'dietary_needs': AnalyticsBucket.dietary_needs
+}
+# Upper bound for per-event ingredient/recipe counts taken from client payloads
+ANALYTICS_MAX_COUNT = 500
+
+def floor_to_bucket(timestamp: datetime, granularity: str) -> datetime:
+    """Truncate a timestamp to the start of its hour or day bucket"""
+    bucket_start = timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        bucket_start = bucket_start.replace(hour=0)
+    return bucket_start
+
+def to_count(value) -> Optional[int]:
+    """Coerce a client-supplied count, clamping it to ANALYTICS_MAX_COUNT"""
+    if isinstance(value, bool):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return min(value, ANALYTICS_MAX_COUNT) if value >= 0 else None
+
+def to_str(value, max_length: int) -> Optional[str]:
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    return str(value).strip()[:max_length] or None
+
+def extract_analytics_fields(data: Any) -> Dict[str, Any]:
+    """Pull frequently queried fields out of an event payload, dropping invalid values"""
+    if not isinstance(data, dict):
+        return {}
+    return {
+        'dietary_needs': to_str(data.get('dietary_needs'), 100),
+        'ingredients_count': to_count(data.get('ingredients_count')),
+        'recipes_count': to_count(data.get('recipes_count')),
+        'recipe_id': to_str(data.get('recipe_id'), 50)
+    }
+
+def increment_analytics_bucket(key: Dict[str, Any], ingredients_count: int, recipes_count: int):
+    """Atomically add one event to a bucket, creating it if needed"""
+    increments = {
+        AnalyticsBucket.event_count: AnalyticsBucket.event_count + 1,
+        AnalyticsBucket.ingredients_total: AnalyticsBucket.ingredients_total + ingredients_count,
+        AnalyticsBucket.recipes_total: AnalyticsBucket.recipes_total + recipes_count
+    }
+    if AnalyticsBucket.query.filter_by(**key).update(increments, synchronize_session=False):
+        return
+    
+    try:
+        with db.session.begin_nested():
+            db.session.add(AnalyticsBucket(
+                event_count=1,
+                ingredients_total=ingredients_count,
+                recipes_total=recipes_count,
+                **key
+            ))
+    except IntegrityError:
+        # Another writer created the bucket first
+        AnalyticsBucket.query.filter_by(**key).update(increments, synchronize_session=False)
+
+def update_analytics_buckets(analytics: UserAnalytics):
+    """Add one event to its hourly and daily aggregate buckets"""
+    for granularity in ANALYTICS_GRANULARITIES:
+        key = {
+            'granularity': granularity,
+            'bucket_start': floor_to_bucket(analytics.timestamp, granularity),
+            'action': analytics.action,
+            'dietary_needs': analytics.dietary_needs or ''
+        }
+        increment_analytics_bucket(key, analytics.ingredients_count or 0, analytics.recipes_count or 0)
+
 def track_user_action(user_id: str, action: str, data: Dict[str, Any] = None):
     """Track user actions for analytics"""
     try:
         analytics = UserAnalytics(
             user_id=user_id,
             action=action,
-            data=json.dumps(data) if data else None
+            data=json.dumps(data) if data else None,
+            timestamp=datetime.utcnow(),
+            **extract_analytics_fields(data)
         )
         db.session.add(analytics)
+        
+        # A failed aggregate update must not lose the raw event
+        try:
+            with db.session.begin_nested():
+                update_analytics_buckets(analytics)
+        except Exception as e:
+            print(f"Analytics bucket error: {e}")
+        
         db.session.commit()
     except Exception as e:
+        db.session.rollback()
         print(f"Analytics tracking error: {e}")
 
 # Admin Routes (for hackathon demo)
@@ -454,10 +942,13 @@ def get_admin_stats():
         stats = {
             "total_users": User.query.count(),
             "total_recipes": Recipe.query.count(),
-            "recipes_generated_today": UserAnalytics.query.filter(
-                UserAnalytics.action == 'recipes_generated',
-                UserAnalytics.timestamp >= datetime.utcnow().date()
-            ).count(),
+            "recipes_generated_today": db.session.query(
+                db.func.coalesce(db.func.sum(AnalyticsBucket.event_count), 0)
+            ).filter(
+                AnalyticsBucket.granularity == 'day',
+                AnalyticsBucket.action == 'recipes_generated',
+                AnalyticsBucket.bucket_start == floor_to_bucket(datetime.utcnow(), 'day')
+            ).scalar(),
             "most_popular_ingredients": get_popular_ingredients(),
             "user_engagement": calculate_user_engagement()
         }
@@ -468,6 +959,50 @@ def get_admin_stats():
         print(f"Error fetching admin stats: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/admin/analytics/export', methods=['GET'])
+def export_analytics():
+    """Stream raw tracked events for all users as newline-delimited JSON"""
+    try:
+        start, end = parse_analytics_window('day')
+    except ValueError:
+        return jsonify({'success': False, 'error': 'start and end must be ISO 8601 timestamps'}), 400
+    if start > end:
+        return jsonify({'success': False, 'error': 'start must not be after end'}), 400
+    action = request.args.get('action')
+    
+    query = UserAnalytics.query.filter(
+        UserAnalytics.timestamp >= start,
+        UserAnalytics.timestamp < end
+    )
+    if action:
+        query = query.filter(UserAnalytics.action == action)
+    
+    def generate():
+        # Fetch in batches so large windows never sit in memory at once
+        for event in query.order_by(UserAnalytics.id).yield_per(1000):
+            yield json.dumps({
+                'id': event.id,
+                'user_id': event.user_id,
+                'action': event.action,
+                'timestamp': event.timestamp.isoformat() if event.timestamp else None,
+                'dietary_needs': event.dietary_needs,
+                'ingredients_count': event.ingredients_count,
+                'recipes_count': event.recipes_count,
+                'recipe_id': event.recipe_id,
+                'data': parse_event_data(event.data)
+            }) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def parse_event_data(raw: str):
+    """Decode a stored event payload, keeping the raw string if it is not valid JSON"""
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
 def get_popular_ingredients():
     """Get most commonly used ingredients"""
     # This would analyze saved recipes to find popular ingredients
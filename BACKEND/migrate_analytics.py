@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+NutriAI analytics migration
+Adds the typed user_analytics columns and indexes, creates analytics_buckets,
+and backfills both from existing events. Also adds recipes.request_key, which
+stays empty for recipes generated before it existed.
+
+Run once with the app stopped, after deploying the new code and before
+starting it, so no live writes race the bucket rebuild:
+
+    python migrate_analytics.py
+"""
+
+import json
+from Flask import (
+    app, db, Recipe, UserAnalytics, AnalyticsBucket,
+    ANALYTICS_GRANULARITIES, floor_to_bucket, extract_analytics_fields
+)
+
+BATCH_SIZE = 1000
+
+def add_missing_columns(model):
+    """ALTER a model's table to add any columns and indexes it is missing"""
+    table = model.__tablename__
+    inspector = db.inspect(db.engine)
+    existing = {c['name'] for c in inspector.get_columns(table)}
+
+    for column in model.__table__.columns:
+        if column.name in existing:
+            continue
+        column_type = column.type.compile(dialect=db.engine.dialect)
+        db.session.execute(db.text(
+            f"ALTER TABLE {table} ADD COLUMN {column.name} {column_type}"
+        ))
+        print(f"Added column {table}.{column.name}")
+    db.session.commit()
+
+    existing_indexes = {i['name'] for i in inspector.get_indexes(table)}
+    for index in model.__table__.indexes:
+        if index.name not in existing_indexes:
+            index.create(bind=db.engine)
+            print(f"Created index {index.name}")
+
+def widen_bucket_totals():
+    """Switch analytics_buckets totals to BIGINT on tables created with INT"""
+    if db.engine.dialect.name != 'mysql':
+        # SQLite integers are already 64-bit
+        return
+    table = AnalyticsBucket.__tablename__
+    columns = {c['name']: c for c in db.inspect(db.engine).get_columns(table)}
+    for name in ('ingredients_total', 'recipes_total'):
+        if not isinstance(columns[name]['type'], db.BigInteger):
+            db.session.execute(db.text(
+                f"ALTER TABLE {table} MODIFY COLUMN {name} BIGINT NOT NULL DEFAULT 0"
+            ))
+            print(f"Widened {table}.{name} to BIGINT")
+    db.session.commit()
+
+def backfill_events():
+    """Fill typed columns from stored payloads and collect bucket totals"""
+    buckets = {}
+    last_id = 0
+    processed = 0
+
+    while True:
+        # Page by id so reads and writes never share an open cursor
+        events = UserAnalytics.query.filter(
+            UserAnalytics.id > last_id
+        ).order_by(UserAnalytics.id).limit(BATCH_SIZE).all()
+        if not events:
+            break
+
+        updates = []
+        for event in events:
+            try:
+                data = json.loads(event.data) if event.data else None
+            except ValueError:
+                data = None
+            fields = extract_analytics_fields(data)
+            updates.append({'id': event.id, **fields})
+
+            if event.timestamp is None:
+                continue
+            for granularity in ANALYTICS_GRANULARITIES:
+                key = (
+                    granularity,
+                    floor_to_bucket(event.timestamp, granularity),
+                    event.action,
+                    fields.get('dietary_needs') or ''
+                )
+                totals = buckets.setdefault(key, [0, 0, 0])
+                totals[0] += 1
+                totals[1] += fields.get('ingredients_count') or 0
+                totals[2] += fields.get('recipes_count') or 0
+
+        db.session.bulk_update_mappings(UserAnalytics, updates)
+        db.session.commit()
+
+        last_id = events[-1].id
+        processed += len(events)
+        print(f"Backfilled {processed} events")
+
+    return buckets
+
+def rebuild_buckets(buckets):
+    """Replace analytics_buckets with totals computed from raw events"""
+    AnalyticsBucket.query.delete()
+    db.session.bulk_insert_mappings(AnalyticsBucket, [
+        {
+            'granularity': granularity,
+            'bucket_start': bucket_start,
+            'action': action,
+            'dietary_needs': dietary_needs,
+            'event_count': event_count,
+            'ingredients_total': ingredients_total,
+            'recipes_total': recipes_total
+        }
+        for (granularity, bucket_start, action, dietary_needs),
+            (event_count, ingredients_total, recipes_total) in buckets.items()
+    ])
+    db.session.commit()
+    print(f"Rebuilt {len(buckets)} analytics buckets")
+
+def main():
+    with app.app_context():
+        # Creates analytics_buckets; existing tables are left untouched
+        db.create_all()
+        add_missing_columns(UserAnalytics)
+        add_missing_columns(Recipe)
+        widen_bucket_totals()
+        rebuild_buckets(backfill_events())
+        print("Analytics migration complete!")
+
+if __name__ == '__main__':
+    main()